@@ -5,45 +5,57 @@ Created: 2025-03-28
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import sys
+import socket
+import gzip
 import time
-from datetime import datetime
+import threading
+import itertools
+import queue
 import argparse
 from colorama import init, Fore, Style
 import os
 import concurrent.futures
 
-# Try to import tqdm, implement a simple version if not available
+# Use orjson for faster JSON encoding/decoding if available, otherwise fall
+# back to the standard library (orjson.JSONDecodeError subclasses json's)
 try:
-    from tqdm import tqdm
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
 except ImportError:
-    print("tqdm not installed, using simple progress indicator")
-    class SimpleTqdm:
-        def __init__(self, total, desc=None, unit=None):
-            self.total = total
-            self.desc = desc or ""
-            self.unit = unit or ""
-            self.n = 0
-            self.last_print = 0
-            print(f"{self.desc}: 0/{self.total} {self.unit} (0%)")
-            
-        def update(self, n=1):
-            self.n += n
-            # Only print every 5% to avoid console spam
-            current_percent = int(self.n / self.total * 100)
-            if current_percent >= self.last_print + 5 or self.n == self.total:
-                self.last_print = current_percent
-                print(f"{self.desc}: {self.n}/{self.total} {self.unit} ({current_percent}%)")
-                
-        def close(self):
-            print(f"{self.desc}: {self.n}/{self.total} {self.unit} (100%) - Complete")
-    
-    tqdm = SimpleTqdm
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+# Use ijson to parse the model list incrementally as it downloads if
+# available, otherwise the whole response is decoded in one go
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # Initialize colorama
 init()
 
+# Colored level tags for log(), built once - escape codes are left out
+# entirely when output is redirected to a file or CI log
+IS_TTY = sys.stdout.isatty()
+LEVEL_COLORS = {
+    "INFO": Fore.BLUE,
+    "SUCCESS": Fore.GREEN,
+    "WARNING": Fore.YELLOW,
+    "ERROR": Fore.RED,
+    "DEBUG": Fore.YELLOW
+}
+LEVEL_PREFIX = {
+    level: f"{color}[{level}]{Style.RESET_ALL} " if IS_TTY else f"[{level}] "
+    for level, color in LEVEL_COLORS.items()
+}
+
 # Configuration
 DEFAULT_CONFIG = {
     "openwebui_url": "https://chat.example.com",
@@ -54,225 +66,962 @@ DEFAULT_CONFIG = {
     "cf_access_client_secret": os.environ.get("CF_ACCESS_CLIENT_SECRET", "default_client_secret"),
     "debug": False,
     "batch_mode": True,  # Default to batch mode
-    "max_workers": 5     # Default to 5 workers for remote connections
+    "max_workers": 5,    # Default to 5 workers for remote connections
+    "rate_limit": None,  # Max requests per second (None = unlimited)
+    "compress_requests": False,  # Gzip large request bodies (server must support it)
+    "bulk_update": True,  # Probe for and use a bulk update endpoint
+    "bulk_update_shape": None,  # Bulk update body shape (None = discover at startup)
+    "adaptive_concurrency": True,  # Back off when the server rate limits or errors
+    "list_endpoint": None,  # Endpoint for listing models (None = discover at startup)
+    "update_endpoint": None,  # Endpoint for updating models (None = discover at startup)
+    "minimal_update": True,  # Send only the new base model if the server allows it
+    "max_retries": 3,    # Retries per request on rate limiting/gateway errors/dropped connections
+    "retry_backoff": 0.3,  # Backoff factor between retries (0.3s, 0.6s, 1.2s, ...)
+    "connect_timeout": 3.05,  # Seconds to wait for a connection
+    "read_timeout": 30   # Seconds to wait for a response
 }
 
+# Request bodies smaller than this are sent uncompressed even with
+# --compress-requests, as gzip overhead outweighs the savings
+COMPRESS_MIN_BYTES = 1024
+
+# Optional fields of the model update form, passed through unchanged when
+# present - the rest of the model record (owner, timestamps, etc.) is
+# read-only and doesn't need to be sent back
+EXTRA_FORM_FIELDS = ("access_control", "is_active")
+
+# Fill-ins for models with no params or capabilities of their own, shared by
+# reference between payloads - a payload is only serialized, never modified
+DEFAULT_PARAMS = {}
+DEFAULT_CAPABILITIES = {}
+
+# Candidate endpoints for updating a model, in order of preference. The one
+# that works is stored in config['update_endpoint'] by the first successful
+# update and reused for every model after that.
+UPDATE_ENDPOINTS = ["/models/model/update", "/models/update"]
+
+# Whether the server merges an update holding only the new base model into
+# the existing model (None until probed with the first model)
+MINIMAL_UPDATE_OK = None
+
+# Set when the server refuses our credentials (401/403) for updates - no
+# further models are attempted after that
+UPDATES_ABORTED = threading.Event()
+
+# Refused updates in a row before the credentials themselves are taken to be
+# at fault. OpenWebUI refuses updates per model (ones the user can't write,
+# and some that no longer exist), so a single refusal only fails that model.
+MAX_REFUSALS_IN_ROW = 5
+
+# Set when a streamed model list breaks off after some models have arrived -
+# the models after the break were never seen, so the run can't be a success
+LISTING_INCOMPLETE = threading.Event()
+
+# Count of update requests refused (401/403) since the last one that
+# succeeded - the run is stopped once it reaches the limit
+class RefusalCounter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_row = 0
+        self.lock = threading.Lock()
+        
+    def record(self, refused):
+        with self.lock:
+            self.in_row = self.in_row + 1 if refused else 0
+            if self.in_row >= self.limit:
+                UPDATES_ABORTED.set()
+
+REFUSALS = RefusalCounter(MAX_REFUSALS_IN_ROW)
+
+# Token bucket used to cap the request rate when --rate-limit is given
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        
+    def acquire(self):
+        # Only block when the bucket has run dry - a fast API is never slowed down
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Take the token even if it isn't there yet; the deficit makes the
+            # next caller wait its turn behind this one
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        
+        if wait > 0:
+            time.sleep(wait)
+
+# Concurrency limit that adapts to how the server is coping (AIMD): it creeps
+# up while requests succeed and is halved when the server rate limits us or
+# errors, so the workers back off instead of all hammering it at once. Each
+# cut starts a new generation - requests already in flight when it was made
+# are answered by the same overload, so they can't cut the limit again.
+class AdaptiveLimiter:
+    def __init__(self, max_limit, min_limit=1, increase=0.5, decrease=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase = increase
+        self.decrease = decrease
+        # Start wide open - a healthy server never sees fewer parallel requests
+        self.limit = max_limit
+        self.in_flight = 0
+        self.generation = 0
+        self.condition = threading.Condition()
+        
+    # Returns the current generation, to be handed back to release()
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return self.generation
+        
+    def release(self, generation, response=None):
+        overloaded = False
+        if response is not None:
+            # Hold on to the permit while the server asks us to slow down
+            pause = rate_limit_pause(response.headers)
+            if pause:
+                time.sleep(pause)
+            
+            # urllib3 retries 429/5xx itself, so look at the attempts it
+            # already made as well as the final status
+            retries = getattr(response.raw, "retries", None)
+            statuses = [response.status_code] + [attempt.status for attempt in getattr(retries, "history", ()) if attempt.status]
+            overloaded = any(status == 429 or status >= 500 for status in statuses)
+        
+        with self.condition:
+            self.in_flight -= 1
+            previous = int(self.limit)
+            if overloaded:
+                # At most one cut per congestion window
+                if generation == self.generation:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.generation += 1
+            elif response is not None and response.ok:
+                self.limit = min(self.max_limit, self.limit + self.increase)
+            current = int(self.limit)
+            self.condition.notify_all()
+        
+        if current < previous:
+            log("DEBUG", f"Server is struggling, reducing concurrency to {current}")
+
+# Progress indicator - workers only bump a counter and a single daemon thread
+# hands the progress lines to the logger, so no worker ever waits on the
+# terminal. total is None when the models are streamed in and the count
+# isn't known up front.
+class ProgressCounter:
+    def __init__(self, total, desc=None, unit=None, interval=0.25):
+        self.total = total
+        self.desc = desc or ""
+        self.unit = unit or ""
+        # Without a total there are no 5% steps, so print at most once a second
+        self.interval = interval if total is not None else max(interval, 1.0)
+        self.n = 0
+        self.lock = threading.Lock()
+        self.last_print = 0
+        self.stopped = threading.Event()
+        if self.total is not None:
+            LOG_QUEUE.put(f"{self.desc}: 0/{self.total} {self.unit} (0%)")
+        self.thread = threading.Thread(target=self.redraw_loop, daemon=True)
+        self.thread.start()
+        
+    def update(self):
+        # The lock is only held for the increment - two workers storing their
+        # counts out of order could otherwise leave a stale total behind
+        with self.lock:
+            self.n += 1
+        
+    def redraw_loop(self):
+        while not self.stopped.wait(self.interval):
+            if self.total is None:
+                # Print the running count whenever it has moved
+                if self.n != self.last_print:
+                    self.last_print = self.n
+                    LOG_QUEUE.put(f"{self.desc}: {self.n} {self.unit}")
+                continue
+            
+            # Only print every 5% to avoid console spam
+            current_percent = int(self.n / self.total * 100) if self.total else 100
+            if current_percent >= self.last_print + 5:
+                self.last_print = current_percent
+                LOG_QUEUE.put(f"{self.desc}: {self.n}/{self.total} {self.unit} ({current_percent}%)")
+        
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.total is None:
+            LOG_QUEUE.put(f"{self.desc}: {self.n} {self.unit} - Complete")
+        elif self.n >= self.total:
+            LOG_QUEUE.put(f"{self.desc}: {self.n}/{self.total} {self.unit} (100%) - Complete")
+        else:
+            # Stopped early - the models never sent aren't counted
+            LOG_QUEUE.put(f"{self.desc}: {self.n}/{self.total} {self.unit} ({int(self.n / self.total * 100)}%) - Stopped")
+
+# Stack size for worker threads - they only make HTTP calls and decode JSON,
+# so a fraction of the platform default (often 8 MB) is plenty and lets
+# many more workers run without reserving memory they never use
+WORKER_STACK_SIZE = 512 * 1024
+
+# Bulk update endpoint probed for at startup - if the server has one, models
+# are updated BULK_CHUNK_SIZE at a time instead of one request each
+BULK_UPDATE_ENDPOINT = "/models/bulk-update"
+BULK_CHUNK_SIZE = 100
+
+# Body shapes the bulk update endpoint may expect - the new base model at the
+# top level, or nested in a "patch" object. The probe stores the one that
+# works in config['bulk_update_shape'].
+BULK_UPDATE_SHAPES = ("flat", "patch")
+
+# Endpoint for fetching a single model, used to check that a bulk update
+# took effect when the server's reply doesn't echo the updated models
+MODEL_ENDPOINT = "/models/model"
+
+# Candidate endpoints for listing models, in order of preference
+MODEL_LIST_ENDPOINTS = ["/models", "/models/", "/models/list", "/v1/models"]
+
+# Where the models sit in a list response when streaming it with ijson - a
+# bare list, or a list under a "models"/"data" key
+MODEL_LIST_PREFIXES = ("item", "models.item", "data.item")
+
+# Bytes read from the socket at a time when streaming the model list
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Per-thread HTTP sessions, plus a list of every session opened so they
+# can all be closed at shutdown
+THREAD_SESSIONS = threading.local()
+OPEN_SESSIONS = []
+OPEN_SESSIONS_LOCK = threading.Lock()
+
+# Rate limiter shared by all workers (None when no rate limit is configured)
+RATE_LIMITER = None
+
+# Adaptive concurrency limit shared by all workers (None when disabled)
+ADAPTIVE_LIMITER = None
+
+# Slow down once fewer than this fraction of the server's rate limit
+# remains, and never pause for longer than MAX_RATE_LIMIT_PAUSE seconds
+RATE_LIMIT_HEADROOM = 0.1
+MAX_RATE_LIMIT_PAUSE = 60
+
+# Last second a message was logged in, with its formatted timestamp
+LOG_TIMESTAMP = (None, "")
+
+# Output lines waiting for the logger thread, which does all the writing to
+# stdout so workers never block on the terminal
+LOG_QUEUE = queue.Queue()
+
 # Function to display messages with timestamp
 def log(level, message):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    if level == "INFO":
-        print(f"{Fore.BLUE}[INFO]{Style.RESET_ALL} {timestamp} - {message}")
-    elif level == "SUCCESS":
-        print(f"{Fore.GREEN}[SUCCESS]{Style.RESET_ALL} {timestamp} - {message}")
-    elif level == "WARNING":
-        print(f"{Fore.YELLOW}[WARNING]{Style.RESET_ALL} {timestamp} - {message}")
-    elif level == "ERROR":
-        print(f"{Fore.RED}[ERROR]{Style.RESET_ALL} {timestamp} - {message}")
-    elif level == "DEBUG" and config["debug"]:
-        print(f"{Fore.YELLOW}[DEBUG]{Style.RESET_ALL} {timestamp} - {message}")
-
-# Function to make API calls with proper headers
-def make_api_call(method, endpoint, data=None, params=None):
-    url = f"{config['openwebui_url']}{config['api_base_path']}{endpoint}"
-    
-    headers = {
-        "Authorization": f"Bearer {config['api_key']}",
-        "CF-Access-Client-Id": config['cf_access_client_id'],
-        "CF-Access-Client-Secret": config['cf_access_client_secret'],
-        "Content-Type": "application/json"
+    # Bail out before any formatting work for disabled debug messages
+    if level == "DEBUG" and not DEBUG:
+        return
+    
+    prefix = LEVEL_PREFIX.get(level)
+    if prefix is None:
+        return
+    
+    # Reformat the timestamp only when the second has changed - the cached
+    # pair is swapped in as one tuple, so threads never see a torn update
+    global LOG_TIMESTAMP
+    now = int(time.time())
+    second, timestamp = LOG_TIMESTAMP
+    if second != now:
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+        LOG_TIMESTAMP = (now, timestamp)
+    
+    LOG_QUEUE.put(f"{prefix}{timestamp} - {message}")
+
+# Function run by the logger thread: writes queued lines in batches until
+# it reaches the None that stop_logger() queues
+def write_log_lines():
+    while True:
+        lines = [LOG_QUEUE.get()]
+        # Pick up everything else already waiting and write it in one go
+        try:
+            while lines[-1] is not None:
+                lines.append(LOG_QUEUE.get_nowait())
+        except queue.Empty:
+            pass
+        
+        stopping = lines[-1] is None
+        if stopping:
+            lines.pop()
+        if lines:
+            sys.stdout.write("\n".join(lines) + "\n")
+            sys.stdout.flush()
+        if stopping:
+            return
+
+# Function to write out everything still queued and stop the logger thread
+def stop_logger():
+    LOG_QUEUE.put(None)
+    LOG_THREAD.join()
+
+# HTTP adapter that sets TCP_NODELAY (so the small update bodies aren't held
+# back by Nagle's algorithm) and SO_KEEPALIVE on every pooled socket
+class KeepAliveAdapter(HTTPAdapter):
+    SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ]
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+# Function to build the retry policy mounted on the session: idempotent
+# GETs and update POSTs are retried on rate limiting, gateway errors and
+# dropped connections with exponential backoff, honouring any Retry-After
+def create_retry():
+    retry_options = {
+        "total": config['max_retries'],
+        "backoff_factor": config['retry_backoff'],
+        "status_forcelist": [429, 502, 503, 504],
+        "allowed_methods": ["GET", "POST"],
+        "respect_retry_after_header": True,
+        # Hand back the final response instead of raising once retries run out
+        "raise_on_status": False
     }
     
-    if config["debug"]:
+    try:
+        # Jitter spreads out retries from parallel workers after a restart
+        return Retry(backoff_jitter=0.2, **retry_options)
+    except TypeError:
+        # urllib3 < 2 has no backoff_jitter
+        return Retry(**retry_options)
+
+# Function to build an HTTP session so connections are kept alive and
+# reused across API calls instead of reconnecting for every model
+def create_session():
+    session = requests.Session()
+    
+    # Each session is only ever used by one thread, so a single pooled
+    # connection is all it needs - the pool can't overflow and start
+    # discarding connections however many workers run. pool_block makes sure
+    # that connection is reused rather than a throwaway one being opened next
+    # to it.
+    adapter = KeepAliveAdapter(
+        pool_connections=1,
+        pool_maxsize=1,
+        pool_block=True,
+        max_retries=create_retry()
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    
+    session.headers.update(HEADERS)
+    
+    return session
+
+# Function to get the calling thread's own session, creating it on first use.
+# Each worker keeps its own warm connection, so workers never contend for a
+# shared connection pool's lock.
+def get_session():
+    session = getattr(THREAD_SESSIONS, "session", None)
+    if session is None:
+        session = create_session()
+        THREAD_SESSIONS.session = session
+        with OPEN_SESSIONS_LOCK:
+            OPEN_SESSIONS.append(session)
+    return session
+
+# Function to close every session handed out by get_session()
+def close_sessions():
+    with OPEN_SESSIONS_LOCK:
+        for session in OPEN_SESSIONS:
+            session.close()
+        OPEN_SESSIONS.clear()
+
+def rate_limit_pause(headers):
+    """
+    Work out how long to wait before the next request from a response's rate
+    limit headers. Returns 0 unless the server is close to its limit
+    """
+    try:
+        remaining = int(headers["x-ratelimit-remaining-requests"])
+        limit = int(headers["x-ratelimit-limit-requests"])
+    except (KeyError, ValueError):
+        return 0
+    
+    if remaining >= limit * RATE_LIMIT_HEADROOM:
+        return 0
+    
+    # Retry-After may also be an HTTP date - just wait a second in that case
+    try:
+        return min(float(headers.get("Retry-After", 1)), MAX_RATE_LIMIT_PAUSE)
+    except ValueError:
+        return 1
+
+def adopt_server_rate_limit(headers):
+    """
+    Start pacing requests by the rate limit the server advertises (requests
+    per minute), used when no --rate-limit was given
+    """
+    global RATE_LIMITER
+    try:
+        limit = int(headers["x-ratelimit-limit-requests"])
+    except (KeyError, ValueError):
+        return
+    
+    # Workers racing here at startup each build the same bucket, and the
+    # reference assignment is atomic under the GIL
+    if limit > 0:
+        RATE_LIMITER = TokenBucket(limit / 60)
+        log("INFO", f"Server allows {limit} requests per minute, pacing updates to match")
+
+# Function to make API calls through the calling thread's session
+# Returns (status code, parsed body) - status is None if no response came back
+# When expected_id is given only the echoed id matters, so a response whose id
+# matches is returned as just {"id": expected_id} without decoding everything
+def make_api_call(method, endpoint, data=None, params=None, expected_id=None):
+    url = BASE_URL + endpoint
+    
+    if DEBUG:
         log("DEBUG", f"Executing API call: {method} {config['api_base_path']}{endpoint}")
     
+    method = method.upper()
+    if method not in ("GET", "POST"):
+        log("ERROR", f"Unsupported HTTP method: {method}")
+        return None, None
+    
+    body = None
+    headers = None
+    if data is not None:
+        body = json_dumps(data)
+        if DEBUG:
+            # Log the body exactly as it goes on the wire, reusing the bytes
+            # just encoded instead of serializing the payload a second time
+            log("DEBUG", f"Request body: {body.decode()}")
+        if COMPRESS_REQUESTS and len(body) >= COMPRESS_MIN_BYTES:
+            body = gzip.compress(body)
+            headers = {"Content-Encoding": "gzip"}
+    
+    if ADAPTIVE_LIMITER:
+        generation = ADAPTIVE_LIMITER.acquire()
+    response = None
     try:
-        if method.upper() == "GET":
-            response = requests.get(url, headers=headers, params=params)
-        elif method.upper() == "POST":
-            response = requests.post(url, headers=headers, json=data, params=params)
-        else:
-            log("ERROR", f"Unsupported HTTP method: {method}")
-            return None
+        response = get_session().request(method, url, data=body, params=params, headers=headers, timeout=TIMEOUT)
+        if RATE_LIMITER is None and ADAPTIVE_LIMITER:
+            adopt_server_rate_limit(response.headers)
+        
+        # Update responses echo the model with its id as the first key in
+        # compact JSON, so checking the id is a single prefix compare on the
+        # raw bytes. Anything else falls back to a full parse (as does debug
+        # mode, for fidelity).
+        if expected_id is not None and not DEBUG:
+            if response.content.startswith(b'{"id":' + json_dumps(expected_id)):
+                return response.status_code, {"id": expected_id}
         
         # Try to parse response as JSON
         try:
-            return response.json()
+            return response.status_code, json_loads(response.content)
         except json.JSONDecodeError:
-            if config["debug"]:
+            if DEBUG:
                 log("DEBUG", f"Response is not JSON: {response.text[:500]}")
-            return response.text
+            return response.status_code, response.text
             
     except requests.exceptions.RequestException as e:
         log("ERROR", f"API call failed: {str(e)}")
+        return None, None
+    finally:
+        if ADAPTIVE_LIMITER:
+            ADAPTIVE_LIMITER.release(generation, response)
+
+def extract_models(response):
+    """
+    Pull the model list out of a models response, whether it is a bare list
+    or wrapped in a "models"/"data" key. Returns None if there is no list
+    """
+    if response is None:
+        return None
+    if isinstance(response, list):
+        return response
+    # Plain lookups rather than isinstance checks - the happy path never raises
+    try:
+        return response['models']
+    except (KeyError, TypeError):
+        pass
+    try:
+        return response['data']
+    except (KeyError, TypeError):
         return None
 
-def update_single_model(model, progress_bar=None):
+def stream_models(endpoint):
     """
-    Update a single model to use the target base model
-    Returns True if successful, False otherwise
+    Yield models from a models endpoint as the response is parsed, so updates
+    can start before the whole list has downloaded and the full list is never
+    held in memory at once
     """
-    model_id = model.get('id', 'unknown')
-    model_name = model.get('name', 'unknown')
-    current_base_model = model.get('base_model_id', 'unknown')
-    target_model = config['target_model']
+    if DEBUG:
+        log("DEBUG", f"Streaming API call: GET {config['api_base_path']}{endpoint}")
     
-    # Skip if we couldn't get a valid ID
-    if model_id == 'unknown' or model_id is None:
-        if progress_bar:
-            progress_bar.update(1)
-        return False
-    
-    # Skip if the model already uses the target model
-    if current_base_model == target_model:
-        if progress_bar:
-            progress_bar.update(1)
-        return True
-    
-    if config["debug"]:
-        log("DEBUG", f"Processing model: {model_name} (ID: {model_id})")
-        log("DEBUG", f"Current base model: {current_base_model}")
-    
-    # Create a complete update payload, preserving all existing fields
-    # and only updating the base_model_id
-    update_payload = model.copy()
-    update_payload['base_model_id'] = target_model
-    
-    # Ensure required fields are present
-    if 'name' not in update_payload:
-        update_payload['name'] = model_name
-    
-    if 'meta' not in update_payload:
-        update_payload['meta'] = {
-            "profile_image_url": "/static/favicon.png",
-            "description": f"{model_name} using {target_model}",
-            "capabilities": {}
-        }
+    # The shape of the response isn't known yet, so parse for every place the
+    # list could be and stick with the first one that turns up models. Numbers
+    # come out as floats rather than ijson's default Decimal, which json_dumps
+    # can't encode (and which wouldn't compare equal to the echoed values).
+    found = {prefix: ijson.sendable_list() for prefix in MODEL_LIST_PREFIXES}
+    parsers = {prefix: ijson.items_coro(found[prefix], prefix, use_float=True) for prefix in MODEL_LIST_PREFIXES}
     
-    if 'params' not in update_payload:
-        update_payload['params'] = {}
+    # The list gets its own session - the response holds its connection open
+    # while models are being yielded, and the calling thread's session must
+    # stay free for the updates it sends in the meantime
+    session = create_session()
+    yielded = False
+    try:
+        with session.get(BASE_URL + endpoint, stream=True, timeout=TIMEOUT) as response:
+            # iter_content() undoes any gzip/deflate content encoding as it reads
+            for chunk in itertools.chain(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), [None]):
+                for prefix, parser in list(parsers.items()):
+                    if chunk is None:
+                        parser.close()
+                    else:
+                        parser.send(chunk)
+                    if found[prefix] and len(parsers) > 1:
+                        parsers = {prefix: parser}
+                
+                for prefix in parsers:
+                    if found[prefix]:
+                        yielded = True
+                    yield from found[prefix]
+                    del found[prefix][:]
+    except (ijson.JSONError, requests.exceptions.RequestException) as e:
+        # Before any models have arrived this is just an endpoint without a
+        # model list (e.g. an HTML page served in its place). After that the
+        # list was cut off, and whatever followed the break was never seen.
+        if yielded:
+            LISTING_INCOMPLETE.set()
+            log("ERROR", f"Model list was cut off part way: {str(e)}")
+        elif isinstance(e, requests.exceptions.RequestException):
+            log("ERROR", f"API call failed: {str(e)}")
+        elif DEBUG:
+            log("DEBUG", f"Response is not a JSON model list: {str(e)}")
+    finally:
+        session.close()
+
+def fetch_models(endpoint):
+    """
+    Fetch the model list from an endpoint. With ijson installed the models are
+    parsed as they stream in and returned as an iterator, otherwise they are
+    returned as a list. Returns None if the endpoint has no models
+    """
+    if ijson is None:
+        return extract_models(make_api_call("GET", endpoint)[1]) or None
     
-    if config["debug"]:
-        log("DEBUG", f"Update payload: {json.dumps(update_payload)}")
+    # Wait for the first model so an endpoint that has none can be passed over
+    models = stream_models(endpoint)
+    first_model = next(models, None)
+    if first_model is None:
+        return None
+    return itertools.chain([first_model], models)
+
+def find_models():
+    """
+    Fetch the model list from the most preferred endpoint that has models,
+    storing that endpoint in config['list_endpoint']. Returns None if none do
+    """
+    endpoints = [config['list_endpoint']] if config['list_endpoint'] else MODEL_LIST_ENDPOINTS
     
-    # Update the model - try the most likely endpoint first
-    update_endpoint = "/models/model/update"
-    update_response = make_api_call("POST", update_endpoint, data=update_payload, params={"id": model_id})
+    # The first endpoint works on almost every server, so it is tried on its
+    # own - fetching every candidate up front would download the list several
+    # times over. Only if it has no models are the alternatives fetched, all
+    # at once rather than one round-trip after another.
+    candidates = [(endpoints[0], fetch_models(endpoints[0]))]
+    if candidates[0][1] is None and len(endpoints) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(endpoints) - 1) as executor:
+            candidates = list(zip(endpoints[1:], executor.map(fetch_models, endpoints[1:])))
     
-    # If first attempt fails, try alternative endpoint
-    if not (update_response and isinstance(update_response, dict) and update_response.get('id') == model_id):
-        update_endpoint = "/models/update"
-        update_response = make_api_call("POST", update_endpoint, data=update_payload, params={"id": model_id})
+    # Models from less preferred endpoints are simply dropped, which closes
+    # any stream still open for them
+    for endpoint, models in candidates:
+        if models is not None:
+            config['list_endpoint'] = endpoint
+            log("DEBUG", f"Listing models from {endpoint}")
+            return models
     
-    success = update_response and isinstance(update_response, dict) and update_response.get('id') == model_id
+    return None
+
+def filter_models(models, target_model, results):
+    """
+    Yield only the models that need updating - the ones already on the target
+    model need no request at all and are counted as skipped instead, and ones
+    without an ID can't be updated and are counted as failed
+    """
+    for model in models:
+        if not model.get('id'):
+            results["failed"] += 1
+        elif model.get('base_model_id') == target_model:
+            results["skipped"] += 1
+        else:
+            yield model
+
+def send_update(model_id, update_payload, verify=False):
+    """
+    POST an update payload, using the known working endpoint if one has been
+    found and otherwise trying each candidate in turn. Returns (status code,
+    echoed model) - the echoed model is None if the update failed, and just
+    {"id": model_id} unless verify is set
+    """
+    endpoints = [config['update_endpoint']] if config['update_endpoint'] else UPDATE_ENDPOINTS
     
-    if progress_bar:
-        progress_bar.update(1)
+    status = None
+    for update_endpoint in endpoints:
+        if RATE_LIMITER:
+            RATE_LIMITER.acquire()
+        status, update_response = make_api_call("POST", update_endpoint, data=update_payload, params={"id": model_id}, expected_id=None if verify else model_id)
+        if isinstance(update_response, dict) and update_response.get('id') == model_id:
+            config['update_endpoint'] = update_endpoint
+            REFUSALS.record(False)
+            return status, update_response
+        
+        # Refused for this model - another endpoint won't be any different
+        if status in (401, 403):
+            REFUSALS.record(True)
+            break
+        
+        # Only move on to the next endpoint if this one doesn't exist (or a
+        # non-JSON page was served in its place). A JSON success in an
+        # unexpected shape may still have applied the update, so it isn't
+        # sent again elsewhere. Other 4xx errors won't improve by retrying,
+        # and 5xx/timeouts were already retried with backoff by the session.
+        if status is None or not (status in (404, 405) or (status < 300 and isinstance(update_response, str))):
+            break
     
-    return success
+    return status, None
 
-def update_models():
-    log("INFO", "Starting model update process...")
-    log("INFO", f"Target model: {config['target_model']}")
-    log("INFO", f"Using OpenWebUI URL: {config['openwebui_url']}{config['api_base_path']}")
+def probe_minimal_update(model, target_model):
+    """
+    Update the first model with a body holding only the new base model, to
+    find out whether the server merges partial updates. The echoed model must
+    still have its name, meta and params - if anything was lost, or the body
+    was rejected, the full payload is sent straight away to restore the model
+    and is used for every model after it. Returns "success" or "failed"
+    """
+    global MINIMAL_UPDATE_OK
+    model_id = model['id']
     
-    # Fetch models - try the most common endpoint first
-    log("INFO", "Fetching models...")
-    models_response = make_api_call("GET", "/models")
-    
-    # If first attempt fails, try alternatives
-    if not (models_response and isinstance(models_response, list)):
-        for endpoint in ["/models/", "/models/list", "/v1/models"]:
-            models_response = make_api_call("GET", endpoint)
-            if models_response and (isinstance(models_response, list) or 
-                                   (isinstance(models_response, dict) and 
-                                    ('models' in models_response or 'data' in models_response))):
-                break
-    
-    # Extract models from response
-    if isinstance(models_response, dict):
-        models = models_response.get('models', models_response.get('data', []))
+    status, echoed = send_update(model_id, {"id": model_id, "base_model_id": target_model}, verify=True)
+    MINIMAL_UPDATE_OK = (
+        echoed is not None
+        and echoed.get('base_model_id') == target_model
+        and all(echoed.get(key) == model.get(key) for key in ("name", "meta", "params"))
+    )
+    if MINIMAL_UPDATE_OK:
+        log("DEBUG", "Server accepts partial updates, sending only the base model")
+        return "success"
+    
+    log("DEBUG", f"Server needs full update payloads (partial update got HTTP {status or 'no response'})")
+    return update_single_model(model)
+
+def update_single_model(model, progress_bar=None):
+    """
+    Update a single model to use the target base model. Only models that need
+    updating get here (see filter_models). Returns "success" or "failed"
+    """
+    model_id = model['id']
+    target_model = config['target_model']
+    
+    # Never sent, so not counted as progress either
+    if UPDATES_ABORTED.is_set():
+        return "failed"
+    
+    # The name and current base model are only looked up where they're used
+    if DEBUG:
+        log("DEBUG", f"Processing model: {model.get('name', 'unknown')} (ID: {model_id})")
+        log("DEBUG", f"Current base model: {model.get('base_model_id', 'unknown')}")
+    
+    # Send just the new base model if the server has been found to accept
+    # that. Otherwise build the full update payload in one go, only changing
+    # the base_model_id. The existing meta/params are shared by reference with
+    # the model record rather than copied - the payload is serialized and
+    # discarded right away. Defaults are only filled in when meta/params are
+    # missing or null; an empty dict is the model's own and is kept as is.
+    if MINIMAL_UPDATE_OK:
+        update_payload = {"id": model_id, "base_model_id": target_model}
     else:
-        models = models_response if isinstance(models_response, list) else []
+        model_name = model.get('name', 'unknown')
+        meta = model.get('meta')
+        if meta is None:
+            meta = {
+                "profile_image_url": "/static/favicon.png",
+                "description": f"{model_name} using {target_model}",
+                "capabilities": DEFAULT_CAPABILITIES
+            }
+        params = model.get('params')
+        if params is None:
+            params = DEFAULT_PARAMS
+        update_payload = {
+            "id": model_id,
+            "name": model_name,
+            "base_model_id": target_model,
+            "meta": meta,
+            "params": params
+        }
+        for key in EXTRA_FORM_FIELDS:
+            if key in model:
+                update_payload[key] = model[key]
     
-    model_count = len(models)
+    status, echoed = send_update(model_id, update_payload)
+    success = echoed is not None
+    if not success:
+        log("ERROR", f"Failed to update model {model.get('name', 'unknown')}: HTTP {status or 'no response'}")
     
-    if model_count == 0:
-        log("ERROR", "No models found in the API response")
-        sys.exit(1)
+    if progress_bar:
+        progress_bar.update()
     
-    log("INFO", f"Found {model_count} models to update")
+    return "success" if success else "failed"
+
+def send_bulk_update(model_ids, target_model, shape=None):
+    """
+    Send one request to the bulk update endpoint for the given model IDs,
+    using the given body shape or else the one found by the probe
+    Returns (status code, IDs of the models confirmed updated) - the IDs are
+    None if the server didn't reply with a JSON success
+    """
+    if (shape or config['bulk_update_shape']) == "patch":
+        bulk_payload = {"ids": model_ids, "patch": {"base_model_id": target_model}}
+    else:
+        bulk_payload = {"ids": model_ids, "base_model_id": target_model}
     
-    # Create progress bar
-    progress_bar = tqdm(total=model_count, desc="Updating models", unit="model")
+    if RATE_LIMITER:
+        RATE_LIMITER.acquire()
+    status, response = make_api_call("POST", BULK_UPDATE_ENDPOINT, data=bulk_payload)
+    if status is None or not 200 <= status < 300 or not isinstance(response, (dict, list)):
+        return status, None
+    return status, confirm_bulk_update(model_ids, target_model, response)
+
+def confirm_bulk_update(model_ids, target_model, response):
+    """
+    Work out which of the model IDs a bulk update actually changed. A reply
+    that echoes the models is checked directly; otherwise the last model of
+    the chunk is fetched back and the chunk only counts if it is now on the
+    target model - a success reply alone doesn't show the body was understood
+    """
+    echoed = extract_models(response)
+    if echoed is not None:
+        wanted = set(model_ids)
+        return [
+            model['id'] for model in echoed
+            if isinstance(model, dict) and model.get('id') in wanted and model.get('base_model_id') == target_model
+        ]
     
-    # Initialize counters
-    successful_updates = 0
-    failed_updates = 0
-    skipped_updates = 0
+    _, sample = make_api_call("GET", MODEL_ENDPOINT, params={"id": model_ids[-1]})
+    if isinstance(sample, dict) and sample.get('base_model_id') == target_model:
+        return model_ids
+    return []
+
+def probe_bulk_update(model_id, target_model):
+    """
+    Probe for a bulk update endpoint by updating one model through it, trying
+    each body shape in turn. Returns True, with the working shape stored in
+    config, if the server has one
+    """
+    for shape in BULK_UPDATE_SHAPES:
+        status, updated = send_bulk_update([model_id], target_model, shape)
+        if updated:
+            config['bulk_update_shape'] = shape
+            return True
+        # Missing endpoint (or a non-JSON page served in its place), refused
+        # credentials or no response - another body shape won't help
+        if status is None or status in (401, 403, 404, 405) or (status < 300 and updated is None):
+            break
+    
+    return False
+
+def update_in_bulk(models_to_update, target_model, results):
+    """
+    Update models in chunks through the bulk update endpoint, once a probe
+    with the first model has shown the server has one
+    """
+    log("INFO", f"Bulk update endpoint available, updating in chunks of {BULK_CHUNK_SIZE}")
+    log("DEBUG", f"Bulk update body shape: {config['bulk_update_shape']}")
+    
+    # Collect IDs into chunks as the models arrive
+    def chunks():
+        chunk = []
+        for model in models_to_update:
+            chunk.append(model['id'])
+            if len(chunk) == BULK_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    
+    workers = config["max_workers"] if config["batch_mode"] else 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # Keep a bounded window of chunks in flight, as for single updates -
+        # executor.map would drain the whole model list into queued tasks
+        # before the first result is looked at
+        chunk_iter = chunks()
+        pending = {
+            executor.submit(send_bulk_update, chunk, target_model): len(chunk)
+            for chunk in itertools.islice(chunk_iter, workers * 2)
+        }
+        
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                count = pending.pop(future)
+                updated = future.result()[1] or []
+                results["success"] += len(updated)
+                results["failed"] += count - len(updated)
+                if len(updated) < count:
+                    log("ERROR", f"Bulk update left {count - len(updated)} of {count} models unchanged")
+                
+                next_chunk = next(chunk_iter, None)
+                if next_chunk is not None:
+                    pending[executor.submit(send_bulk_update, next_chunk, target_model)] = len(next_chunk)
+
+def update_each_model(models_to_update, results, total=None):
+    """
+    Update models one request at a time, tallying each outcome in results.
+    total is the number of models if known up front, None when streaming
+    """
+    if config["batch_mode"]:
+        # Process models in parallel - the work is pure network I/O, so threads
+        # spend their time blocked on sockets with the GIL released. Never start
+        # more threads than there are models to update.
+        workers = max(1, min(config["max_workers"], total)) if total is not None else config["max_workers"]
+        log("INFO", f"Using parallel processing with {workers} workers")
+    else:
+        log("INFO", "Using sequential processing")
+    
+    # Start progress reporting
+    progress_bar = ProgressCounter(total=total, desc="Updating models", unit="model")
     
     if config["batch_mode"]:
-        # Process models in parallel
-        log("INFO", f"Using parallel processing with {config['max_workers']} workers")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=config["max_workers"]) as executor:
-            # Submit all tasks
-            future_to_model = {
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # Keep a bounded window of tasks in flight - the next model is only
+            # submitted once another finishes, so updates stream through the pool
+            # instead of every model being queued up front
+            model_iter = iter(models_to_update)
+            pending = {
                 executor.submit(update_single_model, model, progress_bar): model
-                for model in models
+                for model in itertools.islice(model_iter, workers * 2)
             }
             
             # Process results as they complete
-            for future in concurrent.futures.as_completed(future_to_model):
-                model = future_to_model[future]
-                model_name = model.get('name', 'unknown')
-                
-                try:
-                    success = future.result()
-                    if success:
-                        successful_updates += 1
-                    else:
-                        current_base_model = model.get('base_model_id', 'unknown')
-                        if current_base_model == config['target_model']:
-                            skipped_updates += 1
-                        else:
-                            failed_updates += 1
-                except Exception as e:
-                    log("ERROR", f"Exception updating model {model_name}: {str(e)}")
-                    failed_updates += 1
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    model = pending.pop(future)
+                    
+                    try:
+                        result = future.result()
+                        results[result] += 1
+                    except Exception as e:
+                        log("ERROR", f"Exception updating model {model.get('name', 'unknown')}: {str(e)}")
+                        results["failed"] += 1
+                    
+                    next_model = next(model_iter, None) if not UPDATES_ABORTED.is_set() else None
+                    if next_model is not None:
+                        pending[executor.submit(update_single_model, next_model, progress_bar)] = next_model
+        
+        # Models never submitted after an authorization failure count as failed
+        for _ in model_iter:
+            results["failed"] += 1
     else:
         # Process models sequentially
-        log("INFO", "Using sequential processing")
-        for model in models:
-            model_name = model.get('name', 'unknown')
+        for model in models_to_update:
+            if UPDATES_ABORTED.is_set():
+                results["failed"] += 1
+                continue
             try:
-                success = update_single_model(model, progress_bar)
-                if success:
-                    successful_updates += 1
-                else:
-                    current_base_model = model.get('base_model_id', 'unknown')
-                    if current_base_model == config['target_model']:
-                        skipped_updates += 1
-                    else:
-                        failed_updates += 1
+                result = update_single_model(model, progress_bar)
+                results[result] += 1
             except Exception as e:
-                log("ERROR", f"Exception updating model {model_name}: {str(e)}")
-                failed_updates += 1
-            
-            # Add a small delay to avoid overwhelming the API in sequential mode
-            if not config["batch_mode"]:
-                time.sleep(0.5)
+                log("ERROR", f"Exception updating model {model.get('name', 'unknown')}: {str(e)}")
+                results["failed"] += 1
     
-    # Close progress bar
+    # Stop progress reporting
     progress_bar.close()
+
+def update_models():
+    log("INFO", "Starting model update process...")
+    log("INFO", f"Target model: {config['target_model']}")
+    log("INFO", f"Using OpenWebUI URL: {config['openwebui_url']}{config['api_base_path']}")
+    
+    # Fetch models
+    log("INFO", "Fetching models...")
+    models = find_models()
+    if models is None:
+        log("ERROR", "No models found in the API response")
+        sys.exit(1)
+    
+    # Models already on the target are counted as skipped and never handed to
+    # the workers. A streamed list is filtered as it arrives, so the number of
+    # models isn't known until the end.
+    results = {"success": 0, "skipped": 0, "failed": 0}
+    models_to_update = filter_models(models, config['target_model'], results)
+    total = None
+    if isinstance(models, list):
+        models_to_update = list(models_to_update)
+        total = len(models_to_update)
+    else:
+        log("INFO", "Streaming models, updates start as they arrive")
+    
+    # Probe for a bulk update endpoint with the first model that needs
+    # updating - if the server has one the rest go in chunks, otherwise every
+    # model (the first one included) gets its own update request
+    models_to_update = iter(models_to_update)
+    first_model = next(models_to_update, None)
+    bulk = False
+    if first_model is not None:
+        if config["bulk_update"] and probe_bulk_update(first_model['id'], config['target_model']):
+            bulk = True
+            results["success"] += 1
+        else:
+            log("DEBUG", "No bulk update endpoint, updating models individually")
+            # The first model goes on its own, so the update endpoint (and
+            # whether partial updates work) is known before the workers start
+            # and each of them sends exactly one request per model
+            if config["minimal_update"]:
+                results[probe_minimal_update(first_model, config['target_model'])] += 1
+            else:
+                results[update_single_model(first_model)] += 1
+            if config['update_endpoint']:
+                log("DEBUG", f"Updating models through {config['update_endpoint']}")
+            # A refused first update means the credentials can't update
+            # models at all, so the rest aren't attempted
+            if REFUSALS.in_row:
+                UPDATES_ABORTED.set()
+        total = total - 1 if total is not None else None
+    
+    # Counted once the probe is done, so the number left matches the
+    # progress total
+    if total is not None:
+        if first_model is None:
+            log("INFO", f"Found {len(models)} models, none need updating")
+        else:
+            log("INFO", f"Found {len(models)} models, {total} more need updating")
+    
+    if first_model is not None:
+        if bulk:
+            update_in_bulk(models_to_update, config['target_model'], results)
+        else:
+            update_each_model(models_to_update, results, total)
+    
+    if UPDATES_ABORTED.is_set():
+        log("ERROR", "Stopped early: the server refused updates (HTTP 401/403) with none succeeding in between - check the API key and its permissions")
+    if LISTING_INCOMPLETE.is_set():
+        log("ERROR", "The model list was cut off, so some models were never fetched or updated")
     
     # Summary
     log("INFO", "Model update process completed")
-    log("INFO", f"Successfully updated: {successful_updates} models")
-    log("INFO", f"Skipped (already using target model): {skipped_updates} models")
-    log("INFO", f"Failed to update: {failed_updates} models")
+    log("INFO", f"Successfully updated: {results['success']} models")
+    log("INFO", f"Skipped (already using target model): {results['skipped']} models")
+    log("INFO", f"Failed to update: {results['failed']} models")
     
-    if failed_updates > 0:
+    if results["failed"] > 0 or LISTING_INCOMPLETE.is_set():
         log("WARNING", "Some models could not be updated")
+        # A partial listing means the run didn't cover the whole fleet
+        if LISTING_INCOMPLETE.is_set():
+            sys.exit(1)
     else:
         log("SUCCESS", f"All applicable models have been successfully updated to use {config['target_model']}")
 
@@ -288,6 +1037,15 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action='store_true', help='Enable debug output')
     parser.add_argument('--no-batch', action='store_true', help='Disable batch mode (process sequentially)')
     parser.add_argument('--workers', type=int, help='Number of parallel workers')
+    parser.add_argument('--rate-limit', type=float, help='Maximum update requests per second')
+    parser.add_argument('--compress-requests', action='store_true', help='Gzip large request bodies (only if your server accepts them)')
+    parser.add_argument('--no-bulk', action='store_true', help='Skip probing for a bulk update endpoint')
+    parser.add_argument('--no-adaptive', action='store_true', help='Keep all workers busy even when the server pushes back')
+    parser.add_argument('--full-payload', action='store_true', help='Always send the full model in updates, skipping the partial update probe')
+    parser.add_argument('--timeout', type=float, help='Seconds to wait for each API response')
+    parser.add_argument('--retries', type=int, help='Times to retry a request on rate limiting, gateway errors or dropped connections')
+    parser.add_argument('--list-endpoint', help='Endpoint for listing models, relative to the API path (skips discovery)')
+    parser.add_argument('--update-endpoint', help='Endpoint for updating models, relative to the API path (skips discovery)')
     
     args = parser.parse_args()
     
@@ -312,6 +1070,57 @@ if __name__ == "__main__":
         config['batch_mode'] = False
     if args.workers:
         config['max_workers'] = args.workers
+    if args.rate_limit:
+        config['rate_limit'] = args.rate_limit
+    if args.compress_requests:
+        config['compress_requests'] = True
+    if args.no_bulk:
+        config['bulk_update'] = False
+    if args.no_adaptive:
+        config['adaptive_concurrency'] = False
+    if args.full_payload:
+        config['minimal_update'] = False
+    if args.timeout:
+        config['read_timeout'] = args.timeout
+    if args.retries is not None:
+        config['max_retries'] = args.retries
+    if args.list_endpoint:
+        config['list_endpoint'] = args.list_endpoint
+    if args.update_endpoint:
+        config['update_endpoint'] = args.update_endpoint
+    
+    # Values used by every API call, computed once rather than per request
+    BASE_URL = f"{config['openwebui_url']}{config['api_base_path']}"
+    HEADERS = {
+        "Authorization": f"Bearer {config['api_key']}",
+        "Content-Type": "application/json",
+        # requests decodes compressed responses transparently
+        "Accept-Encoding": "gzip, deflate"
+    }
+    # Cloudflare Access headers only go out when real credentials are set -
+    # the placeholders can't authenticate and would just add bytes to every
+    # request
+    if config['cf_access_client_id'] != "default_client_id":
+        HEADERS["CF-Access-Client-Id"] = config['cf_access_client_id']
+    if config['cf_access_client_secret'] != "default_client_secret":
+        HEADERS["CF-Access-Client-Secret"] = config['cf_access_client_secret']
+    DEBUG = config['debug']
+    COMPRESS_REQUESTS = config['compress_requests']
+    TIMEOUT = (config['connect_timeout'], config['read_timeout'])
+    
+    if config['rate_limit']:
+        RATE_LIMITER = TokenBucket(config['rate_limit'])
+    if config['adaptive_concurrency']:
+        ADAPTIVE_LIMITER = AdaptiveLimiter(config['max_workers'])
+    
+    # Applies to every thread started from here on (logger, workers, progress)
+    threading.stack_size(WORKER_STACK_SIZE)
+    LOG_THREAD = threading.Thread(target=write_log_lines, daemon=True)
+    LOG_THREAD.start()
     
     # Run the update process
-    update_models()
\ No newline at end of file
+    try:
+        update_models()
+    finally:
+        close_sessions()
+        stop_logger()
\ No newline at end of file